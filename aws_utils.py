@@ -1,57 +1,139 @@
 import logging
 import re
 import pathlib
-import s3fs
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+
+try:
+    # google-re2 matches in linear time with no backtracking, use it for key matching if available
+    import re2
+except ImportError:
+    re2 = None
 
 s3_logger = logging.getLogger('main.s3_utils')
 
+# Large objects are transferred as concurrent multipart uploads / byte-range downloads
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, 
+                                 multipart_chunksize=8 * 1024 * 1024, 
+                                 max_concurrency=10)
+
                                                 
-def get_s3_files_to_process(fs, file_pat, bucket, prefix=''):
+def get_s3_files_to_process(s3_client, file_pat, bucket, prefix='', prefix_shards=None, max_workers=8):
     '''
     Get objects in an s3 bucket matching a regex file pattern and optional prefix
     
+    Like an ls, only objects directly under the prefix are considered (not those in sub "folders")
+    
     Parameters:
-    fs (s3fs.S3FileSystem): s3fs file system
-    file_pat (re Pattern): regex pattern with a group capture for sorting
+    s3_client (boto3 S3.Client): boto3 s3 client
+    file_pat (re Pattern): regex pattern with a group capture for sorting, matched against bucket/key
     bucket (str): s3 bucket name
     
     Keyword arguments:
     prefix (str): s3 "folder" prefix
+    prefix_shards (list of str): 
+        optional key prefixes within the "folder" (e.g. ['a', 'b', 'c']) to list concurrently, for very large buckets
+    max_workers (int): max number of threads to use when listing prefix_shards
     
     Returns:
     files (list of str): list of full paths to s3 objects that match the conditions, sorted by the regex capture group
     '''
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    
     try:
-        bucket_contents = fs.ls(bucket+'/'+prefix)
-    except FileNotFoundError as err:
+        if prefix_shards:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                shard_files = executor.map(lambda shard: list_s3_files(s3_client, file_pat, bucket, prefix + shard), 
+                                           prefix_shards)
+                files = [file for shard in shard_files for file in shard]
+        else:
+            files = list_s3_files(s3_client, file_pat, bucket, prefix)
+    except ClientError as err:
         s3_logger.error(f'Error while trying to retrieve contents of {bucket}/{prefix}')
         raise
-        
-    files = []
 
-    s3_logger.info(f'Found {len(bucket_contents)} files to process')
-    for bucket_item in bucket_contents:
-        file_num_search = re.search(file_pat, bucket_item)
-
-        if file_num_search:
-            file = file_num_search.group(0)
-            file_num = file_num_search.group(1)
-            files.append((file_num, file))
+    s3_logger.info(f'Found {len(files)} files to process')
 
     if len(files) > 0 and files[0][0].isdigit():
-        files = sorted(files, key=lambda x: int(x[0])) 
+        # Sort on integer keys with a (stable) numpy argsort, rather than calling int in a python sort key
+        file_nums = np.fromiter((int(file_num) for file_num, _ in files), dtype=np.int64, count=len(files))
+        files = [files[i] for i in np.argsort(file_nums, kind='stable')]
     else:
         files = sorted(files, key=lambda x: x[0]) 
                      
     return files
+
+
+def list_s3_files(s3_client, file_pat, bucket, prefix):
+    '''
+    List objects directly under an s3 prefix page by page, keeping those matching a regex file pattern
+    
+    Parameters:
+    s3_client (boto3 S3.Client): boto3 s3 client
+    file_pat (re Pattern): regex pattern with a group capture for sorting, matched against bucket/key
+    bucket (str): s3 bucket name
+    prefix (str): s3 key prefix
+    
+    Returns:
+    files (list of tuple(str, str)): unsorted list of (regex capture group, full path to s3 object)
+    '''
+    file_matcher = compile_file_pat(file_pat)
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/', PaginationConfig={'PageSize': 1000})
+    
+    files = []
+    
+    for page in pages:
+        for obj in page.get('Contents', []):
+            file_num_search = file_matcher.search(f'{bucket}/{obj["Key"]}')
+
+            if file_num_search:
+                file = file_num_search.group(0)
+                file_num = file_num_search.group(1)
+                files.append((file_num, file))
                 
+    return files
+    
+
+def compile_file_pat(file_pat):
+    '''
+    Compile a file pattern with re2 if it's installed and supports the pattern, else with re
+    
+    Parameters:
+    file_pat (re Pattern or str): regex pattern with a group capture for sorting
+    
+    Returns:
+    compiled pattern exposing search
+    '''
+    if isinstance(file_pat, str):
+        file_pat = re.compile(file_pat)
+    
+    # re2 can't honour re specific flags (other than the default unicode flag for str patterns)
+    if re2 is None or file_pat.flags & ~re.UNICODE:
+        return file_pat
+    
+    try:
+        return re2.compile(file_pat.pattern)
+    except re2.error:
+        s3_logger.debug(f'Pattern {file_pat.pattern} not supported by re2, falling back to re')
+        return file_pat
+    
+    
+def split_bucket_key(s3_bucket_key):
+    '''Split a full s3 object path of the form bucket/key into (bucket, key)'''
+    bucket, key = s3_bucket_key.split('/', 1)
+    return bucket, key
+    
                         
-def download_s3_file(fs, s3_bucket_key, destination):
+def download_s3_file(s3_client, s3_bucket_key, destination):
     '''
     Download s3 object to local destination
     
     Parameters:
-    fs (s3fs.S3FileSystem): s3fs file system
+    s3_client (boto3 S3.Client): boto3 s3 client
     s3_bucket_key (str): full path the s3 object
     destination (pathlib Path): path to download destination file
     '''
@@ -63,21 +145,23 @@ def download_s3_file(fs, s3_bucket_key, destination):
             s3_logger.info(f'Destination {destination.parent.as_posix()} doesn"t exist, creating it')
             destination.parent.mkdir(parents=True, exist_ok=True)    
     
+    bucket, key = split_bucket_key(s3_bucket_key)
+    
     try:
-        fs.get(s3_bucket_key, destination)
-    except FileNotFoundError as err:
+        s3_client.download_file(Bucket=bucket, Key=key, Filename=str(destination), Config=TRANSFER_CONFIG)
+    except ClientError as err:
         s3_logger.error(f'Error while trying to download {s3_bucket_key}')
         raise
                         
     s3_logger.info(f'Successfully downloaded {s3_bucket_key}')
 
                         
-def upload_s3_file(fs, local_file, s3_bucket_key):
+def upload_s3_file(s3_client, local_file, s3_bucket_key):
     '''
     Upload local file to s3
     
     Parameters:
-    fs (s3fs.S3FileSystem): s3fs file system
+    s3_client (boto3 S3.Client): boto3 s3 client
     local_file (pathlib Path): path of local file to upload
     s3_bucket_key (str): full path the s3 object
     '''
@@ -85,6 +169,7 @@ def upload_s3_file(fs, local_file, s3_bucket_key):
         s3_logger.error(f'File {local_file.as_posix()} doesn"t exists')
         raise FileNotFoundError(f'Local File {local_file.as_posix()} not found')
     
-    fs.put(local_file, s3_bucket_key)
+    bucket, key = split_bucket_key(s3_bucket_key)
+    s3_client.upload_file(Filename=str(local_file), Bucket=bucket, Key=key, Config=TRANSFER_CONFIG)
     s3_logger.info(f'Successfully uploaded {local_file.name} to {s3_bucket_key}')
               
@@ -2,19 +2,48 @@ import logging
 import pandas as pd
 import numpy as np
 import re
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from typing import Pattern
 
+import pyarrow as pa
+import pyarrow.compute as pc
+
+try:
+    # Compressed integer bitmaps take far less memory than python sets of ints for the reject row indices
+    from pyroaring import BitMap as RejectIds
+except ImportError:
+    RejectIds = set
+
 du_logger = logging.getLogger('main.data_utils')
 
 # You may want to order by distribution of formatting if you have multiple date formats, as this is a bottleneck
 __KNOWN_DATE_FORMATS = ['%m/%d/%Y %I:%M:%S %p']
 
+# Chunk size for binary reads / writes when splitting files
+__SPLIT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Compiled once at import, rather than on every str.replace call
+_WS_RE = re.compile(r' +')
+
+# re flags that have an RE2 inline flag equivalent
+_RE2_FLAGS = {re.I: 'i', re.M: 'm', re.S: 's'}
+
+# Result of scrub_field, to be written back to the DataFrame by update_field
+ScrubbedField = namedtuple('ScrubbedField', ['field', 'field_orig', 'field_mask', 'generated'])
+
+
+def clean_col_name(col):
+    '''Convert a column name to lower case and replace spaces with underscores'''
+    return _WS_RE.sub('_', col.lower())
+
 
 def clean_col_names(df):
     '''Convert column names to lower case and replace spaces with underscores'''
     if pd.api.types.is_string_dtype(df.columns):
-        df.columns = df.columns.str.lower().str.replace(' +', '_')
+        df.columns = df.columns.str.lower().str.replace(_WS_RE, '_', regex=True)
 
 
 def remove_excess_white_space(df):
@@ -26,7 +55,77 @@ def remove_excess_white_space(df):
     '''
     for col in df.columns:
         if pd.api.types.is_string_dtype(df[col].dtype):
-            df[col] = df[col].str.strip().str.replace(' +', ' ')
+            # Pass the pattern source, since pandas 2.2 sends compiled patterns on Arrow strings down its slow python path
+            df[col] = df[col].str.strip().str.replace(_WS_RE.pattern, ' ', regex=True)
+
+
+@lru_cache(maxsize=None)
+def anchored_pattern(pattern):
+    '''
+    Anchor a compiled re pattern at the start, so searching methods (e.g. str.extract) mirror re.match
+    
+    Parameters:
+    pattern (Regex Pattern): compiled re pattern
+    
+    Returns:
+    Regex Pattern, compiled with the same flags
+    '''
+    return re.compile(f'^(?:{pattern.pattern})', pattern.flags)
+
+
+@lru_cache(maxsize=None)
+def re2_pattern(pattern):
+    '''
+    Translate a compiled re pattern into RE2 source, anchored at the start to mirror re.match
+    
+    Parameters:
+    pattern (Regex Pattern): compiled re pattern
+    
+    Returns:
+    str with the RE2 pattern, or None if the pattern uses flags or syntax (e.g. lookarounds) RE2 can't handle
+    '''
+    flags = pattern.flags & ~re.UNICODE
+    inline = ''.join(flag for re_flag, flag in _RE2_FLAGS.items() if flags & re_flag)
+    
+    if flags & ~(re.I | re.M | re.S):
+        return None
+    
+    re2_pat = (f'(?{inline})' if inline else '') + f'^(?:{pattern.pattern})'
+    
+    # Check once (the result is cached) that RE2 can compile it, Arrow only compiles the regex for non-empty input
+    try:
+        pc.match_substring_regex(pa.array([''], type=pa.string()), re2_pat)
+    except pa.ArrowInvalid:
+        du_logger.debug(f'Pattern {pattern.pattern} not supported by RE2, falling back to re')
+        return None
+    
+    return re2_pat
+
+
+def match_regex(series, pattern):
+    '''
+    Equivalent of series.str.match(pattern, na=False), run on Arrow's RE2 engine for Arrow backed strings
+    
+    RE2 matches in linear time without backtracking, falls back to re for other dtypes, 
+    or if RE2 can't handle the pattern
+    
+    Parameters:
+    series (Series of str): strings to match
+    pattern (Regex Pattern): compiled re pattern
+    
+    Returns:
+    Series of bool
+    '''
+    re2_pat = re2_pattern(pattern)
+    
+    if re2_pat is not None and isinstance(series.dtype, pd.StringDtype) and series.dtype.storage == 'pyarrow':
+        matches = pc.match_substring_regex(pa.array(series), re2_pat).fill_null(False)
+        return pd.Series(matches.to_numpy(zero_copy_only=False), index=series.index)
+    
+    # pandas' str.match can't reliably take compiled patterns on Arrow backed strings (or with some flags), 
+    # depending on the pandas version, so run the pattern with re directly (non strings / nulls don't match)
+    return pd.Series([isinstance(value, str) and pattern.match(value) is not None for value in series.to_numpy(dtype=object)], 
+                     index=series.index, dtype=bool)
 
 
 def parse_dt(dt, formats=__KNOWN_DATE_FORMATS):
@@ -52,11 +151,37 @@ def parse_dt(dt, formats=__KNOWN_DATE_FORMATS):
         return dt
     else:
         return np.nan
+
+
+def parse_dt_vec(dates, formats=__KNOWN_DATE_FORMATS):
+    '''
+    Vectorized version of parse_dt, parsing a whole series with pd.to_datetime.
+    
+    Each format is tried in turn, and only the rows still unparsed are passed on to the next format.
+    
+    Parameters:
+    dates (Series of str): string dates
     
+    Keyword arguments:
+    formats (list of str): strptime style string formats (default -> local known formats)
     
-def process_field(df, field_name, rejects, 
-                  other_nulls=[], pre_process=[], date_field=False, validation=None,  
-                  post_process=[], valid_values=None, generated_cols=[], drop_field=False):
+    Returns:
+    Series of datetime64, with NaT where no format could parse the date
+    '''
+    parsed = None
+    remaining = dates
+    
+    for fmt in formats:
+        attempt = pd.to_datetime(remaining, format=fmt, errors='coerce', cache=True)
+        # Not preallocated as ns, since dates out of the ns range come back at a coarser unit on pandas 3
+        parsed = attempt if parsed is None else parsed.combine_first(attempt)
+        remaining = remaining.loc[attempt.isna()]
+        if remaining.empty: break
+        
+    return parsed.reindex(dates.index)
+    
+    
+def process_field(df, field_name, rejects, drop_field=False, **scrub_params):
     '''
     Clean, validate and/or transform a DataFrame field (column) inplace.
     
@@ -73,13 +198,61 @@ def process_field(df, field_name, rejects,
         (if validation failed (step 4) or valid values failed (step 6))
     10) (Optionally) drop the original field
     
+    Steps 1-7 are done by scrub_field, steps 8-10 by update_field.
+    
     The resulting data frame will have clean values in the original field, and a new column of the form
     field_name + _orig, containing the original field value IF any validation error occured in step 4 or step 6
     
     Parameters:
     df (DataFrame): DataFrame to be manipulated (inplace)
     field_name: field in DataFrame to work on
-    rejects (dict of <str, set of ints>): dict with history of errors to update on validation errors
+    rejects (dict of <str, RejectIds>): dict with history of errors to update on validation errors
+    
+    Keyword arguments:
+    drop_field (bool):
+        If true, field will be dropped (e.g. if you're only interested in generated columns)
+    scrub_params:
+        Passed through to scrub_field
+    '''
+    scrubbed = scrub_field(df[field_name], **scrub_params)
+    update_field(df, field_name, rejects, scrubbed, drop_field=drop_field)
+    
+    
+def process_fields(df, fields, rejects, max_workers=4):
+    '''
+    Process several independent fields of a DataFrame in parallel (inplace).
+    
+    Each field is scrubbed on its own copy of the column in a worker thread (pandas string kernels 
+    spend most of their time outside of the GIL), then the results are written back to the DataFrame 
+    one at a time, in the order of fields, since DataFrame assignment is not thread safe.
+    
+    Parameters:
+    df (DataFrame): DataFrame to be manipulated (inplace)
+    fields (dict of <str, dict>): field names and the keyword arguments to pass to process_field
+    rejects (dict of <str, RejectIds>): dict with history of errors to update on validation errors
+    
+    Keyword arguments:
+    max_workers (int): max number of threads to use
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for field_name, params in fields.items():
+            scrub_params = {key: val for key, val in params.items() if key != 'drop_field'}
+            futures[field_name] = executor.submit(scrub_field, df[field_name].copy(), **scrub_params)
+            
+        for field_name, future in futures.items():
+            du_logger.debug(f'Updating {field_name}')
+            update_field(df, field_name, rejects, future.result(), 
+                         drop_field=fields[field_name].get('drop_field', False))
+    
+    
+def scrub_field(series, other_nulls=[], pre_process=[], date_field=False, validation=None,  
+                post_process=[], valid_values=None, generated_cols=[], extract_into=None):
+    '''
+    Clean, validate and/or transform a series, without touching the DataFrame it came from (see process_field).
+    
+    Parameters:
+    series (Series): field to work on
     
     Keyword arguments:
     other_nulls (list of str): 
@@ -87,75 +260,131 @@ def process_field(df, field_name, rejects,
     pre_process (list of tuple(Regex Pattern, str)): 
         Each regex pattern will be search/replaced prior to validation
     date_field (bool): 
-        If True validation will redirect to parse_dt
+        If True validation will redirect to parse_dt_vec
     validation (None or Regex Pattern or Lambda):
         If None, field is not validated (passed through)
         If Regex Pattern, a FULL match is considered valid
         If Lambda, lambda should take a series, and return a series of dtype bool
-    post_process (list of tuple(Regex Pattern, str) or tuple(None, Lambda))
-        If list of tuple(Regex Pattern, str), each pattern will be search/replaced
-        If list of tuple(None, Lambda), the lambda should take a series and return a series
+    post_process (list of tuple(Regex Pattern, str) or tuple('title') or tuple('upper') or tuple('fn', Lambda) or tuple(None, Lambda))
+        If tuple(Regex Pattern, str), the pattern will be search/replaced
+        If tuple('title') or tuple('upper'), the field will be title / upper cased
+        If tuple('fn', Lambda), the lambda should take a series and return a series
     valid_values (list of str)
-        Anything not in the list of valid values will be rejected
+        Anything not in the list of valid values will be rejected (categorical series are compared by category code)
     generated_cols (list of functions)
         Any supplied function should be of the form def some_function(df, series).  
-        The current df will be passed along with the series, and any generated columns can be appended in your function
-    drop_field (bool):
-        If true, field will be dropped (e.g. if you're only interested in generated columns)
+        An empty DataFrame sharing the series index will be passed along with the series, 
+        and any generated columns can be appended to it in your function
+    extract_into (list of str)
+        If validation is a Regex Pattern, new column names for its capture groups.  The groups are extracted in the 
+        same pass as the validation (anchored at the start like any other Pattern validation, and before any post 
+        processing), and the first group must not be optional, as a match is determined by it being non-null
+        
+    Returns:
+    ScrubbedField, or None if every value of the series is null
     '''
-    field_orig = df.loc[df[field_name].notnull() & df[field_name].ne(''), field_name].copy()
+    # Boolean indexing already returns a new series, and every step below returns a new series 
+    # rather than mutating it, so field can start out as the same object as field_orig
+    field_orig = series.loc[series.notnull() & series.ne('')]
     for other_null in other_nulls:
         field_orig = field_orig.loc[~field_orig.eq(other_null)]
         
-    field = field_orig.copy()
+    field = field_orig
     
     # If everything is null
     if len(field_orig) == 0:
-        df[field_name] = np.nan
-        df[field_name + '_orig'] = np.nan
-
-        return
+        return None
 
     # Pre Process (Clean data before validation)
     for pat, repl in pre_process:
-        field = field.str.replace(pat, repl)
+        assert isinstance(pat, Pattern), f'pre_process patterns must be compiled, got {type(pat)}'
+        field = field.str.replace(pat, repl, regex=True)
         
     # Validation
     if not date_field:
-        if validation is not None and isinstance(validation, Pattern):
-            field_mask = field.str.match(validation, na=False) # specifying na=false|true guaruntees the dtype will be bool
+        if validation is not None and isinstance(validation, Pattern) and extract_into:
+            # Validate and extract in one pass of the regex
+            extracted = field.str.extract(anchored_pattern(validation), expand=True)
+            extracted.columns = extract_into
+            field_mask = extracted.iloc[:, 0].notna()
+        elif validation is not None and isinstance(validation, Pattern):
+            field_mask = match_regex(field, validation)
         elif validation is not None and callable(validation):
             field_mask = validation(field)
         else:
             field_mask = field.eq(field)
     else:
-        field = field.apply(parse_dt)
-        field_mask = field.notnull()
+        field = parse_dt_vec(field)
+        field_mask = field.notna()
         
     # Update field to non-null and valid
     field = field.loc[field_mask]
 
     # Post Process (Cosmetic changes after validation)
-    for pat, fn_or_str in post_process:
-        if pat is not None and isinstance(pat, Pattern):
-            field = field.str.replace(pat, fn_or_str)
-        elif pat is None and callable(fn_or_str):
-            field = fn_or_str(field)
+    for op, *args in post_process:
+        if isinstance(op, Pattern):
+            field = field.str.replace(op, args[0], regex=True)
+        elif op == 'title':
+            field = field.str.title()
+        elif op == 'upper':
+            field = field.str.upper()
+        elif op == 'fn' or (op is None and callable(args[0])):
+            # (None, Lambda) is the older form of ('fn', Lambda)
+            field = args[0](field)
+        else:
+            raise ValueError(f'Unknown post_process operation {op}')
         
     # Check valid values if present
     if valid_values is not None:
-        field_mask = field_mask & field.isin(valid_values)
+        if isinstance(field.dtype, pd.CategoricalDtype):
+            # Compare integer codes rather than hashing strings (anything not in valid_values gets code -1)
+            valid = field.cat.set_categories(valid_values).cat.codes.ge(0)
+        else:
+            valid = field.isin(valid_values)
+        field_mask = field_mask & valid
         field = field.loc[field_mask]
         
     # Apply custom functions to generate new fields 
+    generated = pd.DataFrame(index=series.index)
+    if extract_into and not date_field and isinstance(validation, Pattern):
+        generated[extract_into] = extracted.loc[field.index]
+        
     for fn in generated_cols:
-        fn(df, field)
+        fn(generated, field)
+        
+    return ScrubbedField(field, field_orig, field_mask, generated)
+
+
+def update_field(df, field_name, rejects, scrubbed, drop_field=False):
+    '''
+    Write the result of scrub_field back into a DataFrame (inplace) and record any rejects.
+    
+    Parameters:
+    df (DataFrame): DataFrame to be manipulated (inplace)
+    field_name: field in DataFrame to update
+    rejects (dict of <str, RejectIds>): dict with history of errors to update on validation errors
+    scrubbed (ScrubbedField or None): result of scrub_field for the field
+    
+    Keyword arguments:
+    drop_field (bool):
+        If true, field will be dropped (e.g. if you're only interested in generated columns)
+    '''
+    # If everything is null
+    if scrubbed is None:
+        df[field_name] = np.nan
+        df[field_name + '_orig'] = np.nan
+
+        return
+    
+    for col in scrubbed.generated.columns:
+        df[col] = scrubbed.generated[col]
 
     # Update
-    rejects[field_name].update(field_mask.loc[~field_mask].index)
-    df[field_name + '_orig'] = field_orig.loc[~field_mask]
+    field_mask = scrubbed.field_mask
+    rejects[field_name].update(field_mask.index[~field_mask.to_numpy()])
+    df[field_name + '_orig'] = scrubbed.field_orig.loc[~field_mask]
     if not drop_field:
-        df[field_name] = field
+        df[field_name] = scrubbed.field
     else:
         df.drop(field_name, axis='columns', inplace=True)
 
@@ -165,25 +394,23 @@ def analyze_hard_and_soft_rejects(hard_rejects, soft_rejects):
     Summarize rejected rows (hard rejects) and fields (soft rejects).
     
     Parameters:
-    hard_rejects (dict of <str, list of int>): field names and list of hard reject indices
-    soft_rejects (dict of <str, list of int>): field names and list of soft reject indices
+    hard_rejects (dict of <str, RejectIds>): field names and hard reject indices
+    soft_rejects (dict of <str, RejectIds>): field names and soft reject indices
     
     Returns:
-    unique_hard_rejects (set of int): set intersection of all hard reject indices
-    unique_soft_rejects (set of int): set intersection of all soft reject indices
+    unique_hard_rejects (RejectIds): union of all hard reject indices
+    unique_soft_rejects (RejectIds): union of all soft reject indices
     '''
-    unique_hard_rejects = set()
-    unique_soft_rejects = set()
+    unique_hard_rejects = RejectIds().union(*hard_rejects.values())
+    unique_soft_rejects = RejectIds().union(*soft_rejects.values())
     total_soft_fields_bad = 0
 
     for key in hard_rejects.keys():
-        unique_hard_rejects = unique_hard_rejects | hard_rejects[key]
         du_logger.info(f'Hard rejects {key}: {len(hard_rejects[key]):,}')
 
     du_logger.info('')
 
     for key in soft_rejects.keys():
-        unique_soft_rejects = unique_soft_rejects | soft_rejects[key]
         du_logger.info(f'Soft rejects {key}: {len(soft_rejects[key]):,}')
         total_soft_fields_bad += len(soft_rejects[key])
 
@@ -203,39 +430,51 @@ def generate_reject_dfs(df, df_filt, file_name, hard_rejects, unique_hard_reject
     df (DataFrame): the original unaltered DataFrame before any processing
     df_filt (DataFrame): the DataFrame filtered of hard rejects and processed for soft rejects
     hard_rejects (dict of col_name -> indices): column names and indices of offending rows for hard rejects
-    unique_hard_rejects (set of indices): unique indices of any row resulting in a hard reject
+    unique_hard_rejects (RejectIds): unique indices of any row resulting in a hard reject
     soft_rejects (dict of col_name -> indices): column names and indices of offending rows for soft rejects
-    unique_soft_rejects (set of indices): unique indices of any row resulting in a soft reject
+    unique_soft_rejects (RejectIds): unique indices of any row resulting in a soft reject
     
     Returns:
     hard_rej_df (DataFrame): filtered DataFrame with hard reject rows, along with the file name and columns that failed
     soft_rej_df (DataFrame): filtered DataFrame with soft reject rows, along with the file name and columns that failed
     '''
-    hard_rej_df = df.loc[unique_hard_rejects].copy()
-    hard_rej_df.insert(0, 'file_name', file_name)
-    hard_rej_df.insert(1, 'cols', np.nan)
-    cols = []
-        
-    for row_id in unique_hard_rejects:
-        bad_cols = [key for key in hard_rejects.keys() if row_id in hard_rejects[key]]            
-        cols.append(';'.join(bad_cols))
-        
-    hard_rej_df['cols'] = cols
+    # Invert the rejects once (row id -> columns), rather than checking every column for every row
+    hard_rej_cols = invert_rejects(hard_rejects)
+    hard_rej_ids = list(unique_hard_rejects)
     
-    soft_rej_df = df_filt.loc[unique_soft_rejects].copy()
-    soft_rej_df.insert(0, 'file_name', file_name)
-    soft_rej_df.insert(1, 'cols', np.nan)
-    cols.clear()
+    hard_rej_df = df.loc[hard_rej_ids].copy()
+    hard_rej_df.insert(0, 'file_name', file_name)
+    hard_rej_df.insert(1, 'cols', [';'.join(hard_rej_cols[row_id]) for row_id in hard_rej_ids])
     
-    for row_id in unique_soft_rejects:
-        bad_cols = [key for key in soft_rejects.keys() if row_id in soft_rejects[key]]            
-        cols.append(';'.join(bad_cols))
+    soft_rej_cols = invert_rejects(soft_rejects)
+    soft_rej_ids = list(unique_soft_rejects)
     
-    soft_rej_df['cols'] = cols
+    soft_rej_df = df_filt.loc[soft_rej_ids].copy()
+    soft_rej_df.insert(0, 'file_name', file_name)
+    soft_rej_df.insert(1, 'cols', [';'.join(soft_rej_cols[row_id]) for row_id in soft_rej_ids])
                                
     return hard_rej_df, soft_rej_df
     
 
+def invert_rejects(rejects):
+    '''
+    Invert a rejects dict of column name -> row indices into row index -> column names
+    
+    Parameters:
+    rejects (dict of col_name -> indices): column names and indices of offending rows
+    
+    Returns:
+    defaultdict of <int, list of str>: row indices and the names of the columns rejected for that row (in column order)
+    '''
+    rej_cols = defaultdict(list)
+    
+    for col, ids in rejects.items():
+        for row_id in ids:
+            rej_cols[row_id].append(col)
+            
+    return rej_cols
+    
+
 def split_file(file, has_headers=True, include_headers=True, headers=None, max_lines=1_000_000):
     '''
     Split a text file into smaller files
@@ -259,30 +498,55 @@ def split_file(file, has_headers=True, include_headers=True, headers=None, max_l
     
     split_files = []
     
-    with file.open('r') as raw_in:
+    with file.open('rb') as raw_in:
         if has_headers:
             if include_headers and headers is None:
                 headers = raw_in.readline()
+                
+        if include_headers and headers is not None:
+            if isinstance(headers, str): headers = headers.encode('utf-8')
+            # The header counts towards max_lines
+            lines_per_file = max(max_lines - 1, 1)
+        else:
+            lines_per_file = max_lines
             
-        line_cnt, out_file_cnt = 0, 0
+        lines_left, out_file_cnt = 0, 0
         
         raw_out = None
         
-        for line in raw_in:
-            if line_cnt % max_lines == 0:
-                line_cnt = 1 if include_headers and headers is not None else 0
-                out_file_cnt += 1
-
-                if raw_out is not None: raw_out.close()
-                
-                out_file = file.parent/file.name.replace(file.suffix, f'_{out_file_cnt:0>3d}{file.suffix}')
-                du_logger.info(f'Writting to file {out_file.name}')
-                split_files.append(out_file)
-                raw_out = out_file.open('w')
-                if include_headers and headers is not None: raw_out.write(f'{headers}')
+        # Copy in large binary chunks, only looking for newlines to know where to switch files
+        while True:
+            chunk = raw_in.read(__SPLIT_CHUNK_SIZE)
+            if not chunk: break
             
-            raw_out.write(line)            
-            line_cnt += 1
+            pos = 0
+            while pos < len(chunk):
+                if lines_left == 0:
+                    out_file_cnt += 1
+                    
+                    if raw_out is not None: raw_out.close()
+                    
+                    out_file = file.parent/file.name.replace(file.suffix, f'_{out_file_cnt:0>3d}{file.suffix}')
+                    du_logger.info(f'Writting to file {out_file.name}')
+                    split_files.append(out_file)
+                    raw_out = out_file.open('wb', buffering=__SPLIT_CHUNK_SIZE)
+                    if include_headers and headers is not None: raw_out.write(headers)
+                    lines_left = lines_per_file
+                
+                newlines = chunk.count(b'\n', pos)
+                
+                if newlines < lines_left:
+                    # Rest of the chunk fits in the current file
+                    raw_out.write(chunk[pos:])
+                    lines_left -= newlines
+                    pos = len(chunk)
+                else:
+                    # Find the offset of the last newline that fits in the current file
+                    newline_offsets = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8, offset=pos) == ord('\n'))
+                    end = pos + newline_offsets[lines_left - 1] + 1
+                    raw_out.write(chunk[pos:end])
+                    lines_left = 0
+                    pos = end
     
     if raw_out is not None: raw_out.close()
     
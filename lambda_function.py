@@ -5,11 +5,14 @@ import sys
 
 from pathlib import Path
 from collections import defaultdict, namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import pandas as pd
 import numpy as np
-import s3fs
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.fs as pafs
 
 import aws_utils
 import data_utils
@@ -37,6 +40,13 @@ MY_REGX = ScrubRE(TWO_LETTERS=re.compile(r'^[a-z]{2}$', flags=re.I),
                       ZIP_CODES=re.compile(r'^\d{5}|\d{4}$')
                       )
 
+# File system is created once per container, so warm invocations reuse credentials and connection pools
+ARROW_S3_FS = pafs.S3FileSystem()
+
+# pd.read_csv's default null values, so the Arrow csv reader nulls the same strings
+PANDAS_NULL_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', 
+                      '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
 logger = logging.getLogger()
 logger.name = 'main'
 logger.setLevel(logging.INFO)
@@ -54,16 +64,13 @@ def lambda_handler(event, context):
     s3_bucket_key = f'{s3_bucket}/{s3_key}'
     logger.info(f'Processing {s3_bucket_key}')
     
-    s3 = s3fs.S3FileSystem()
+    keep_cols = ['id', 'case_number', 'date', 'block', 'iucr', 'primary_type', 'description', 'location_description',
+                'arrest', 'domestic', 'beat', 'district', 'ward', 'community_area', 'location', 'zip_codes']
   
-    with s3.open(s3_bucket_key, 'r') as file:
-        df = pd.read_csv(file, low_memory=False, encoding='utf-8', dtype=str)
+    df = read_csv_from_s3(s3_bucket_key, keep_cols)
     
     data_utils.clean_col_names(df)
     
-    keep_cols = ['id', 'case_number', 'date', 'block', 'iucr', 'primary_type', 'description', 'location_description',
-                'arrest', 'domestic', 'beat', 'district', 'ward', 'community_area', 'location', 'zip_codes']
-    
     df = df[keep_cols]
     
     data_utils.remove_excess_white_space(df)
@@ -83,33 +90,79 @@ def lambda_handler(event, context):
     logger.info(f'Uploading soft rejects to {s3_soft_up_bucket_key}')
     logger.info(f'Uploading clean data to {s3_clean_up_bucket_key}')
     
-    with s3.open(s3_hard_up_bucket_key, 'w') as hard_up, \
-            s3.open(s3_soft_up_bucket_key, 'w') as soft_up, \
-            s3.open(s3_clean_up_bucket_key, 'w') as clean_up:
-        hard_rej_df.to_csv(hard_up, index_label='file_index', encoding='utf-8')
-        soft_rej_df.to_csv(soft_up, index_label='file_index', encoding='utf-8')
+    clean_cols = [col for col in df_filt.columns if '_orig' not in col]
+    
+    # Each upload is a blocking PUT, so run them concurrently
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        uploads = [executor.submit(upload_csv, s3_hard_up_bucket_key, hard_rej_df, index_label='file_index'),
+                   executor.submit(upload_csv, s3_soft_up_bucket_key, soft_rej_df, index_label='file_index'),
+                   executor.submit(upload_csv, s3_clean_up_bucket_key, df_filt[clean_cols])]
         
-        clean_cols = [col for col in df_filt.columns if '_orig' not in col]
-        df_filt[clean_cols].to_csv(clean_up, index=False, encoding='utf-8')
+        # Re-raise any upload errors
+        for upload in uploads:
+            upload.result()
     
     logger.info('Success')
     
     return 'success'
   
 
-def process_hard_rejects(df):
+def read_csv_from_s3(s3_bucket_key, keep_cols):
+    # Quoted values may contain newlines (which pd.read_csv handled)
+    parse_options = pacsv.ParseOptions(newlines_in_values=True)
+    
+    # keep_cols are cleaned column names, so map them back to the raw names in the header
+    # (Arrow's own header parsing handles quoting and a utf-8 BOM). The streaming reader reads ahead in the
+    # background, so it gets its own handle rather than sharing (and seeking) the one read_csv uses
+    with ARROW_S3_FS.open_input_stream(s3_bucket_key) as head, pacsv.open_csv(head, parse_options=parse_options) as reader:
+        header = reader.schema.names
+    raw_cols = [col for col in header if data_utils.clean_col_name(col) in keep_cols]
+    
+    # Arrow's multithreaded csv reader, reading only the columns we want, all as strings
+    with ARROW_S3_FS.open_input_file(s3_bucket_key) as file:
+        table = pacsv.read_csv(file, 
+                               read_options=pacsv.ReadOptions(block_size=8 << 20),
+                               parse_options=parse_options,
+                               convert_options=pacsv.ConvertOptions(column_types={col: pa.string() for col in raw_cols},
+                                                                    include_columns=raw_cols,
+                                                                    null_values=PANDAS_NULL_VALUES,
+                                                                    strings_can_be_null=True))
+    
+    # Keep the strings Arrow backed, so the pandas str methods run on Arrow compute kernels
+    return table.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get)
+    
+
+def upload_csv(s3_bucket_key, df, index_label=None):
+    # Arrow's multithreaded csv writer, streaming straight to s3
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if index_label is not None:
+        table = table.add_column(0, index_label, pa.array(df.index))
+        
+    # Arrow writes timestamp[ns] with nanoseconds, so write whole second timestamps at second resolution (like pandas)
+    for i, column in enumerate(table.columns):
+        if pa.types.is_timestamp(column.type):
+            try:
+                table = table.set_column(i, table.field(i).name, column.cast(pa.timestamp('s')))
+            except pa.ArrowInvalid:
+                pass
+    
+    with ARROW_S3_FS.open_output_stream(s3_bucket_key) as file:
+        pacsv.write_csv(table, file)
     
-    df_filt = df.copy()
+    logger.info(f'Uploaded {s3_bucket_key}')
+
+
+def process_hard_rejects(df):
     
-    logger.info(f'Length of records before hard rejects {len(df_filt):,}')
+    logger.info(f'Length of records before hard rejects {len(df):,}')
     
-    hard_rejects = defaultdict(set)
+    hard_rejects = defaultdict(data_utils.RejectIds)
 
     # Column specific logic
     # id -> Not null, must be digits
     id_val = lambda series: series.str.isdigit()
     # case_number -> Not null, first two must be alpha
-    case_number_val = lambda series: series.str.slice(0,2).str.match(MY_REGX.TWO_LETTERS)
+    case_number_val = lambda series: data_utils.match_regex(series.str.slice(0,2), MY_REGX.TWO_LETTERS)
     
     # date -> Not null, try to parse known formats, also want to extract year, month
     def date_yr_mo(df, dates):
@@ -121,60 +174,62 @@ def process_hard_rejects(df):
     nonnull_fields['case_number'] = {'validation': case_number_val}
     nonnull_fields['date'] = {'date_field': True, 'other_nulls': ['0000-00-00'], 'generated_cols': [date_yr_mo]}
 
+    # Scrub without touching df, since it's needed unaltered for the hard reject output
+    scrubbed = {}
     for field, params in nonnull_fields.items():
         logger.debug(f'Processing {field}')
-        data_utils.process_field(df_filt, field, hard_rejects, **params)
+        scrubbed[field] = data_utils.scrub_field(df[field], **params)
 
-    # Filter out hard rejects
-    for _, ids in hard_rejects.items():
-        if len(ids) > 0: 
-            df_filt = df_filt.loc[~df_filt.index.isin(ids)]
+    # Filter out hard rejects in a single pass, using one positional mask for all fields 
+    # (take returns a new frame, so no need to copy df first)
+    bad = np.zeros(len(df), dtype=bool)
+    for result in scrubbed.values():
+        if result is not None:
+            bad[df.index.get_indexer(result.field_mask.index[~result.field_mask])] = True
+            
+    df_filt = df.take(np.flatnonzero(~bad))
+    
+    for field, result in scrubbed.items():
+        data_utils.update_field(df_filt, field, hard_rejects, result)
 
     logger.info(f'Length of records after hard rejects {len(df_filt):,}')
     
     return df_filt, hard_rejects
     
     
-def process_soft_rejects(df_filt):
+def process_soft_rejects(df_filt, category_fields=('arrest', 'domestic')):
 
-    soft_rejects = defaultdict(set)
-
-    # Generic cosmetic changes (post-processing)
-    capitalize_first = lambda series: series.str.title()
-    upper_case = lambda series: series.str.upper()
-
-    # Block we want to extract the hidden house number from the street location so we can analyze crime by street
-    def block_num_addr(df, blocks):
-        df[['house_num', 'street_addr']] = blocks.str.extract(MY_REGX.BLOCK, expand=True)
+    soft_rejects = defaultdict(data_utils.RejectIds)
+    
+    # Enum like fields take far less memory as categoricals, and their valid values are checked by category code
+    for field in category_fields:
+        df_filt[field] = df_filt[field].astype('category')
 
-    primary_type_post = [(None, capitalize_first)]
+    primary_type_post = [('title',)]
     # Combine regex validation and max length 50
-    description_val = lambda series: series.str.match(MY_REGX.DESCRIPTION, na=False) & series.str.len().le(50)
-    description_post = [(None, capitalize_first)]
+    description_val = lambda series: data_utils.match_regex(series, MY_REGX.DESCRIPTION) & series.str.len().le(50)
+    description_post = [('title',)]
     # Combine regex validation and max length 50
-    location_description_val = lambda series: series.str.match(MY_REGX.LOCATION_DESCRIPTION, na=False) & series.str.len().le(50)
-    location_description_post = [(None, capitalize_first)]
+    location_description_val = lambda series: data_utils.match_regex(series, MY_REGX.LOCATION_DESCRIPTION) & series.str.len().le(50)
+    location_description_post = [('title',)]
     # arrest / domestic fields look to be all True / False, so let's just confirm this with a valid values constraint
     tf_valid = ['true', 'false']
     # beat, district, ward, community area, look to be all integer fields, so for these four, we will 
     # validate it's an int
     valid_int = lambda series: series.str.isdigit()
 
-    # Location, we want to extract lat / lon into their own columns
-    def location_lat_lon(df, locations):
-        df[['latitude','longitude']] = locations.str.extract(MY_REGX.LOCATION, expand=True)
-
     # Zip codes need to be stripped of 0 precision (automatic float conversion)
     # Also, we want to prefix 4 length zip codes with a '0' at the beginning after validation
+    # Left padding is a single pass (one Arrow kernel), and anything not length 4 or 5 is nulled
     def zip_to_five(zips):
-        condlist = [zips.str.len().eq(4), zips.str.len().eq(5)]
-        choicelist = ['0' + zips, zips]
-        return pd.Series(index=zips.index, data=np.select(condlist, choicelist, default=np.nan))
+        lengths = zips.str.len()
+        return zips.str.pad(5, side='left', fillchar='0').where(lengths.eq(4) | lengths.eq(5))
 
-    post_zip_codes = [(None, lambda series: zip_to_five(series))]
+    post_zip_codes = [('fn', zip_to_five)]
 
     nullable_fields = {}
-    nullable_fields['block'] = {'validation': MY_REGX.BLOCK, 'generated_cols': [block_num_addr]}
+    # Block we want to extract the hidden house number from the street location so we can analyze crime by street
+    nullable_fields['block'] = {'validation': MY_REGX.BLOCK, 'extract_into': ['house_num', 'street_addr']}
     nullable_fields['iucr'] = {'validation': MY_REGX.IUCR}
     nullable_fields['primary_type'] = {'validation': MY_REGX.PRIMARY_TYPE, 'post_process': primary_type_post}
     nullable_fields['description'] = {'validation': description_val, 'post_process': description_post}
@@ -185,12 +240,12 @@ def process_soft_rejects(df_filt):
     nullable_fields['district'] = {'validation': valid_int}
     nullable_fields['ward'] = {'validation': valid_int}
     nullable_fields['community_area'] = {'validation': valid_int}
-    nullable_fields['location'] = {'validation': MY_REGX.LOCATION, 'generated_cols': [location_lat_lon]}
+    # Location, we want to extract lat / lon into their own columns
+    nullable_fields['location'] = {'validation': MY_REGX.LOCATION, 'extract_into': ['latitude', 'longitude']}
     nullable_fields['zip_codes'] = {'validation': MY_REGX.ZIP_CODES, 'post_process': post_zip_codes}
 
-    for field, params in nullable_fields.items():
-        logger.debug(f'Processing {field}')
-        data_utils.process_field(df_filt, field, soft_rejects, **params)
+    # Soft reject fields are independent of one another, so process them in parallel
+    data_utils.process_fields(df_filt, nullable_fields, soft_rejects)
         
     return soft_rejects
     